@@ -3,76 +3,205 @@
 Author: Nina Belyavskaya
 """
 
+import os
+from collections import defaultdict
 from contextlib import asynccontextmanager
-import asyncio
 
-from fastapi import FastAPI, HTTPException, status, Depends
+from fastapi import FastAPI, HTTPException, status, Depends, Query
+from fastapi.responses import ORJSONResponse
+from pydantic import AwareDatetime
 from .models import (
-    Device, DeviceShort, DeviceView,
-    Metric, MetricShort, 
+    Device, DeviceView,
+    Metric, MetricBase, MetricShort, DeviceTypeMetricLink,
     Site, SiteShort, SiteView, 
     DeviceType, DeviceTypeShort, DeviceTypeView,
-    Measure, LastMeasure, MeasureShort, MeasuresHistory
+    Measure, LastMeasure, MeasuresHistory
 )
-from .measure import mock
+from .measure import MEASURE_FUNCS, SQL_MEASURES
 from .db import AsyncSession, create_db_and_tables, get_async_session, async_session_maker
 from sqlmodel import select
-from apscheduler.schedulers.background import BackgroundScheduler
+from sqlalchemy import delete, func, insert, lambda_stmt, literal
+from sqlalchemy.exc import IntegrityError
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from datetime import datetime, timezone
 from fastapi.logger import logger
-from sqlalchemy.orm import selectinload
+from sqlalchemy.orm import joinedload, raiseload, selectinload
+from cachetools import TTLCache
+
+def start_scheduler() -> AsyncIOScheduler:
+    """Start running measure_devices every 180 seconds on the current event loop."""
+    scheduler = AsyncIOScheduler()
+    # A slow run must not overlap or queue up behind the next one
+    scheduler.add_job(measure_devices, 'interval', seconds=180, id="measure",
+                      coalesce=True, max_instances=1, misfire_grace_time=60,
+                      replace_existing=True)
+    scheduler.start()
+    return scheduler
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """
-    Lifespan event handler to create the database and tables at startup.
+    Lifespan event handler to create the database and tables at startup
+    and to run measure_devices every 180 seconds on the application loop.
     This function is called when the FastAPI application starts.
     """
-    await create_db_and_tables()
+    # With several API workers, set MEASURE_IN_APP=0 and run `python -m app.worker`
+    # once instead: it creates the tables and runs the job, so neither
+    # happens concurrently in every worker
+    scheduler = None
+    if os.environ.get("MEASURE_IN_APP", "1") != "0":
+        await create_db_and_tables()
+        await check_metric_calls()
+        scheduler = start_scheduler()
     yield
+    if scheduler:
+        scheduler.shutdown(wait=False)
 
-app = FastAPI(title="Device Monitoring API", lifespan=lifespan)
+app = FastAPI(title="Device Monitoring API", lifespan=lifespan,
+              default_response_class=ORJSONResponse)
 
+# Short-lived cache for read-heavy GET responses. Keys are the response path
+# ("sites", "site/1/", "device/2/"...) and writes drop the keys they affect.
+_response_cache = TTLCache(maxsize=1024, ttl=30)
 
-async def measure_devices():
+
+def _invalidate(*prefixes: str):
+    """Drop every cached response whose key starts with one of the prefixes."""
+    for key in [key for key in _response_cache if key.startswith(prefixes)]:
+        _response_cache.pop(key, None)
+
+# Statements issued on every call, built once per process
+_STMT_SITES = lambda_stmt(lambda: select(Site))
+_STMT_DEVICE_TYPES = lambda_stmt(lambda: select(DeviceType))
+_STMT_METRICS = lambda_stmt(lambda: select(Metric))
+
+
+def _active_device_metrics(*columns):
+    """Select the given columns for every (active device, metric of its type) pair."""
+    return (
+        select(*columns)
+        .join(DeviceTypeMetricLink, DeviceTypeMetricLink.device_type_id == Device.device_type_id)
+        .join(Metric, Metric.id == DeviceTypeMetricLink.metric_id)
+        .where(Device.is_active)
+    )
+
+
+# Pairs measured in Python; the SQL_MEASURES ones are inserted by the database
+_SQL_CALLS = tuple(SQL_MEASURES)
+_STMT_ACTIVE_DEVICE_METRICS = lambda_stmt(
+    lambda: _active_device_metrics(Device, Metric).where(Metric.call.not_in(_SQL_CALLS))
+)
+
+
+def _select_by_ids(*lookups):
     """
-    Function to measure devices and store results in the database.
-    This function should be called periodically by the scheduler.
+    Build one statement fetching several rows by primary key, given as
+    (Model, id) pairs. Each model is outer-joined onto a one-row anchor,
+    so the result always has one row and a missing entity comes back as None.
+    """
+    stmt = select(*(model for model, _ in lookups)).select_from(
+        select(literal(1)).subquery()
+    )
+    for model, pk in lookups:
+        stmt = stmt.outerjoin(model, model.id == pk)
+    return stmt
+
+
+async def check_metric_calls():
+    """
+    Check that every Metric.call stored in the database has a measure function,
+    so misconfigured metrics are reported at startup rather than during the job.
     """
-    logger.info("Starting measurement of devices")
     async with async_session_maker() as session:
-        res = await session.execute(select(Device).options(
-            selectinload(Device.device_type).selectinload(DeviceType.metrics)
-        ).where(Device.is_active))
-        devices = res.scalars().all()
-        for device in devices:
-                for metric in device.device_type.metrics:
-                    func = globals().get(metric.call)
-                    if not callable(func):
-                        raise ValueError(f"Function '{metric.call}' not found or not callable")
-                    
-                    value = func(metric, device)  # Call the function dynamically
-                    measure = Measure(
-                        device_id=device.id,
-                        metric_id=metric.id,
-                        value=value,
-                        timestamp=datetime.now(timezone.utc)  # Use UTC timezone                                                                                     
-                    )
-                    session.add(measure)
-        await session.commit()
-    logger.info("Measurement of devices completed")
+        res = await session.execute(select(Metric.name, Metric.call))
+        for name, call in res.all():
+            if call not in MEASURE_FUNCS:
+                logger.warning(f"Metric '{name}' uses unknown function '{call}'")
 
-def measure_devices_job():
+
+async def _delete_by_id(session: AsyncSession, model, id: int) -> str | None:
     """
-    Job to run the measure_devices function periodically.
-    This function is called by the scheduler.
+    Delete one row with a single DELETE ... RETURNING and commit, leaving
+    dependent rows to the ON DELETE CASCADE foreign keys.
+    Returns the deleted row's name, or None if there was no such row.
+    A row still referenced without a cascade is reported as 409.
     """
-    asyncio.run(measure_devices())
+    try:
+        res = await session.execute(
+            delete(model).where(model.id == id).returning(model.name)
+            .execution_options(synchronize_session=False)
+        )
+        name = res.scalar_one_or_none()
+        await session.commit()
+    except IntegrityError:
+        await session.rollback()
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f"{model.__name__} {id} is still in use")
+    return name
 
-# Initialize the scheduler to run measure_devices every 30 seconds
-scheduler = BackgroundScheduler()
-scheduler.add_job(measure_devices_job, 'interval', seconds=180)
-scheduler.start()
+
+async def measure_devices():
+    """
+    Function to measure devices and store results in the database.
+    This function should be called periodically by the scheduler.
+    """
+    logger.info("Starting measurement of devices")
+    # One transaction per sweep: committed when the block ends, rolled back
+    # as a whole if a collector fails
+    async with async_session_maker() as session, session.begin():
+        timestamp = datetime.now(timezone.utc)  # Use UTC timezone
+        inserted = 0
+        for call, value in SQL_MEASURES.items():
+            res = await session.execute(
+                insert(Measure).from_select(
+                    ["device_id", "metric_id", "value", "timestamp"],
+                    _active_device_metrics(
+                        Device.id, Metric.id, value,
+                        literal(timestamp, Measure.__table__.c.timestamp.type),
+                    ).where(Metric.call == call),
+                )
+            )
+            inserted += res.rowcount
+        res = await session.execute(_STMT_ACTIVE_DEVICE_METRICS)
+        pairs = res.all()
+        if not pairs and not inserted:
+            logger.info("No active devices to measure")
+            return
+        # Group pairs by function so each collector is called once per sweep
+        buckets: dict[str, list[tuple[Metric, Device]]] = defaultdict(list)
+        for device, metric in pairs:
+            buckets[metric.call].append((metric, device))
+        rows = []
+        for call, items in buckets.items():
+            try:
+                measure_batch = MEASURE_FUNCS[call]
+            except KeyError:
+                names = ", ".join(sorted({metric.name for metric, _ in items}))
+                logger.error(f"Function '{call}' not found, skipping metrics: {names}")
+                continue
+            values = measure_batch(items)
+            try:
+                # A value count that does not match the pairs would shift values onto
+                # the wrong pairs, so the whole batch is dropped instead
+                batch_rows = [
+                    {
+                        "device_id": device.id,
+                        "metric_id": metric.id,
+                        "value": value,
+                        "timestamp": timestamp,
+                    }
+                    for (metric, device), value in zip(items, values, strict=True)
+                ]
+            except ValueError:
+                logger.error(f"Function '{call}' returned {len(values)} values for {len(items)} pairs, skipping")
+                continue
+            rows.extend(batch_rows)
+        if rows:
+            # Core table insert: one executemany, no ORM unit-of-work bookkeeping
+            await session.execute(Measure.__table__.insert(), rows)
+    if inserted or rows:
+        _invalidate("device/")  # last measures changed
+    logger.info("Measurement of devices completed")
 
 @app.get("/", response_model=dict|list[SiteShort])
 # return string if sitelist is empty or SiteList with links to sites
@@ -80,14 +209,18 @@ async def sites(session: AsyncSession = Depends(get_async_session)):
     """
     Main page that lists all sites.
     """
-    res = await session.execute(select(Site))
+    key = "sites"
+    if key in _response_cache:
+        return _response_cache[key]
+    res = await session.execute(_STMT_SITES)
     sites = res.scalars().all()
     if not sites:
         print("The system is empty, please create a site first.")
-        return {"message": "The system is empty, please create a site first."}
-    return [SiteShort(
-        id=site.id, name=site.name, link=site.link
-        ) for site in sites]
+        result = {"message": "The system is empty, please create a site first."}
+    else:
+        result = [SiteShort.model_validate(site) for site in sites]
+    _response_cache[key] = result
+    return result
 
 @app.get("/site/{id}", response_model=SiteView)
 # site details with its devices
@@ -96,19 +229,17 @@ async def site_page(id: int, session: AsyncSession = Depends(get_async_session))
     Get details of a specific site by its ID.
     This endpoint returns the site information along with its devices and their types.
     """
-    res = await session.execute(select(Site).options(
-            selectinload(Site.devices).selectinload(Device.device_type)
-        ).where(Site.id==id))
-    site = res.scalar_one_or_none()
+    key = f"site/{id}/"
+    if key in _response_cache:
+        return _response_cache[key]
+    site = await session.get(Site, id, options=[
+        selectinload(Site.devices).joinedload(Device.device_type), raiseload("*")
+    ])
     if not site:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Site not found")
-    return SiteView(
-        id=site.id,
-        name=site.name,
-        devices=[DeviceShort(
-            id=device.id, name=device.name, link=device.link,    
-        ) for device in site.devices]
-     ) if site.devices else []
+    result = SiteView.model_validate(site)
+    _response_cache[key] = result
+    return result
 
 @app.post("/site/", response_model=Site)
 # create new site
@@ -119,7 +250,7 @@ async def site_new(site: Site, session: AsyncSession = Depends(get_async_session
     """
     session.add(site)
     await session.commit()
-    session.refresh(site)
+    _invalidate("sites")
     return site
 
 @app.post("/site/{id}", response_model=Site)
@@ -130,13 +261,12 @@ async def site_edit(id: int,
     Edit an existing site by its ID.
     This endpoint allows you to update the name of a site.
     """
-    res = await session.execute(select(Site).where(Site.id==id))
-    site = res.scalar_one_or_none()
+    site = await session.get(Site, id)
     if not site:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Site not found")
     site.name = site_data.name
     await session.commit()
-    session.refresh(site)
+    _invalidate("sites", f"site/{id}/", "device/")
     return site
 
 @app.delete("/site/{id}", response_model=dict)
@@ -146,13 +276,11 @@ async def site_delete(id: int, session: AsyncSession = Depends(get_async_session
     Delete a site by its ID.
     This endpoint removes the site and all associated devices.
     """
-    res = await session.execute(select(Site).where(Site.id==id))
-    site = res.scalar_one_or_none()
-    if not site:
+    name = await _delete_by_id(session, Site, id)
+    if name is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Site not found")
-    session.delete(site)
-    await session.commit()
-    return {"ok": True, "message": f"Site {site.name} deleted"}
+    _invalidate("sites", f"site/{id}/", "device/")
+    return {"ok": True, "message": f"Site {name} deleted"}
 
 @app.get("/device_types/", response_model=list[DeviceTypeShort])
 # all device types
@@ -160,12 +288,14 @@ async def device_types(session: AsyncSession = Depends(get_async_session)):
     """Get a list of all device types.
     This endpoint returns all device types available in the system.
     """
-    res = await session.execute(select(DeviceType))
+    key = "device_types"
+    if key in _response_cache:
+        return _response_cache[key]
+    res = await session.execute(_STMT_DEVICE_TYPES)
     device_types = res.scalars().all()
-    return [
-        DeviceTypeShort(
-            id=dt.id, name=dt.name, link=dt.link
-        ) for dt in device_types]
+    result = [DeviceTypeShort.model_validate(dt) for dt in device_types]
+    _response_cache[key] = result
+    return result
 
 @app.get("/device_type/{id}", response_model=DeviceTypeView)
 # device_type with its metrics
@@ -174,27 +304,19 @@ async def device_type_page(id: int, session: AsyncSession = Depends(get_async_se
     Get details of a specific device type by its ID.
     This endpoint returns the device type information along with its metrics.
     """
-    res = await session.execute(select(DeviceType).options(
-        selectinload(DeviceType.metrics)
-    ).where(DeviceType.id==id))
-    device_type = res.scalar_one_or_none()
+    device_type = await session.get(DeviceType, id, options=[
+        selectinload(DeviceType.metrics), raiseload("*")
+    ])
     if not device_type:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Device Type not found")
-    return DeviceTypeView(id=device_type.id, name=device_type.name,
-            link=device_type.link,
-            # Include metrics if they exist",
-            metrics=[MetricShort(
-                id=metric.id, name=metric.name, unit=metric.unit, 
-                link=metric.link
-            ) for metric in device_type.metrics]
-            if device_type.metrics else [])
+    return DeviceTypeView.model_validate(device_type)
 
 @app.post("/device_type/", response_model=DeviceType)
 # create new device type
 async def device_type_new(device_type: DeviceType, session: AsyncSession = Depends(get_async_session)):
     session.add(device_type)
     await session.commit()
-    session.refresh(device_type)
+    _invalidate("device_types")
     return device_type
 
 @app.post("/device_type/{id}", response_model=DeviceType)
@@ -205,13 +327,12 @@ async def device_type_edit(id: int,
     Edit an existing device type by its ID.
     This endpoint allows you to update the name of a device type.
     """    
-    res = await session.execute(select(DeviceType).where(DeviceType.id==id))
-    device_type = res.scalar_one_or_none()
+    device_type = await session.get(DeviceType, id)
     if not device_type:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Device Type not found")
     device_type.name = device_type_data.name
     await session.commit()
-    session.refresh(device_type)
+    _invalidate("device_types", "device/")
     return device_type
 
 @app.post("/device_type/{id}/add_metric/{metric_id}", response_model=DeviceTypeView)
@@ -221,31 +342,20 @@ async def device_type_add_metric(id: int, metric_id: int, session: AsyncSession
     This endpoint associates a metric with a device type by their IDs.
     If the metric is already associated, it raises an error.
     """
-    res = await session.execute(select(DeviceType).options(
-        selectinload(DeviceType.metrics)
-    ).where(DeviceType.id==id))
-    device_type = res.scalar_one_or_none()
+    res = await session.execute(
+        _select_by_ids((DeviceType, id), (Metric, metric_id))
+        .options(joinedload(DeviceType.metrics))
+    )
+    device_type, metric = res.unique().one()
     if not device_type:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Device Type not found")
-    res = await session.execute(select(Metric).where(Metric.id==id))
-    metric = res.scalar_one_or_none()
     if not metric:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Metric not found")
     if metric in device_type.metrics:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Metric already exists in Device Type")
     device_type.metrics.append(metric)
     await session.commit()
-    session.refresh(device_type)
-    return DeviceTypeView(
-        id=device_type.id,
-        name=device_type.name,
-        link=device_type.link,
-        metrics=[MetricShort(
-            id=metric.id, name=metric.name, unit=metric.unit,
-            link=metric.link
-            ) for metric in device_type.metrics
-        ]
-    )
+    return DeviceTypeView.model_validate(device_type)
 
 @app.post("/device_type/{id}/remove_metric/{metric_id}", response_model=DeviceTypeView)
 # remove metric from device type
@@ -254,31 +364,20 @@ async def device_type_remove_metric(id: int, metric_id: int, session: AsyncSessi
     This endpoint disassociates a metric from a device type by their IDs.
     If the metric is not associated with the device type, it raises an error.
     """
-    res = await session.execute(select(DeviceType).options(
-        selectinload(DeviceType.metrics)
-    ).where(DeviceType.id==id))
-    device_type = res.scalar_one_or_none()
+    res = await session.execute(
+        _select_by_ids((DeviceType, id), (Metric, metric_id))
+        .options(joinedload(DeviceType.metrics))
+    )
+    device_type, metric = res.unique().one()
     if not device_type:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Device Type not found")
-    res = await session.execute(select(Metric).where(Metric.id==id))
-    metric = res.scalar_one_or_none()
     if not metric:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Metric not found")
     if metric not in device_type.metrics:   
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Metric not found in Device Type")
     device_type.metrics.remove(metric)
     await session.commit()
-    session.refresh(device_type)
-    return DeviceTypeView(
-        id=device_type.id,
-        name=device_type.name,
-        link=device_type.link,
-        metrics=[MetricShort(
-            id=metric.id, name=metric.name, unit=metric.unit,
-            link=metric.link
-            ) for metric in device_type.metrics
-        ]
-    )
+    return DeviceTypeView.model_validate(device_type)
 
 
 @app.delete("/device_type/{id}", response_model=dict)
@@ -287,61 +386,71 @@ async def device_type_delete(id: int, session: AsyncSession = Depends(get_async_
     """Delete a device type by its ID.
     This endpoint removes the device type and all associated devices.
     """
-    res = await session.execute(select(DeviceType).where(DeviceType.id==id))
-    device_type = res.scalar_one_or_none()
-    if not device_type:
+    # Databases created before the link table cascaded still need this,
+    # it runs in the same transaction as the delete below
+    await session.execute(
+        delete(DeviceTypeMetricLink).where(DeviceTypeMetricLink.device_type_id == id)
+    )
+    name = await _delete_by_id(session, DeviceType, id)
+    if name is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Device Type not found")
-    session.delete(device_type)
-    await session.commit()
-    return {"ok": True, "message": f"Device Type {device_type.name} deleted"}
+    _invalidate("device_types", "site/", "device/")
+    return {"ok": True, "message": f"Device Type {name} deleted"}
 
 @app.get("/device/{id}", response_model=DeviceView)
 # device, its site and device_type with last metrics
 async def device(id: int, session: AsyncSession = Depends(get_async_session)):
-    res = await session.execute(select(Device).options(
-        selectinload(Device.site),selectinload(Device.device_type)
-    ).where(Device.id==id))
-    device = res.scalar_one_or_none()
+    key = f"device/{id}/"
+    if key in _response_cache:
+        return _response_cache[key]
+    device = await session.get(Device, id, options=[
+        joinedload(Device.site), joinedload(Device.device_type), raiseload("*")
+    ])
     if not device:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Device not found")
     
-    # Query last measure for each metric
+    # Query only the last measure for each metric
+    latest = select(
+        Measure.id,
+        func.row_number().over(
+            partition_by=Measure.metric_id, order_by=Measure.timestamp.desc()
+        ).label("rn")
+    ).where(Measure.device_id == id).subquery()
     res = await session.execute(
         select(Measure).options(
-            selectinload(Measure.metric)
-        ).where(Measure.device_id == id)
-        .order_by(Measure.metric_id, Measure.timestamp.desc())
+            joinedload(Measure.metric), raiseload("*")
+        ).join(latest, Measure.id == latest.c.id)
+        .where(latest.c.rn == 1)
     )
-    measures = res.scalars().all()
-
-    # Group measures by metric_id and get the latest for each
-    last_measures = {}
-    for measure in measures:
-        if measure.metric_id not in last_measures:
-            last_measures[measure.metric_id] = measure
-
-    return DeviceView(
-        id=device.id,
-        name=device.name,
-        link=device.link,
-        is_active=device.is_active,
-        site=SiteShort(
-            id=device.site.id, name=device.site.name, link=device.site.link
-        ),
-        device_type=DeviceTypeShort(
-            id=device.device_type.id, name=device.device_type.name, link=device.device_type.link
-        ),
-        last_measures=[LastMeasure(
-                timestamp=measure.timestamp,
-                metric=measure.metric.name,
-                value=measure.value,
-                unit=measure.metric.unit,
-                link=f"/history/{device.id}/{measure.metric_id}"
-            )
-            for measure in last_measures.values()
-        ])
+    last_measures = res.scalars().all()
+
+    view = DeviceView.model_validate(device)
+    view.last_measures = [LastMeasure(
+            timestamp=measure.timestamp,
+            metric=measure.metric.name,
+            value=measure.value,
+            unit=measure.metric.unit,
+            link=f"/history/{device.id}/{measure.metric_id}"
+        )
+        for measure in last_measures
+    ]
+    _response_cache[key] = view
+    return view
 
 
+async def _commit_device(session: AsyncSession):
+    """
+    Commit a new or edited device, reporting a site or device type that
+    does not exist (foreign key violation) as 404.
+    """
+    try:
+        await session.commit()
+    except IntegrityError as e:
+        await session.rollback()
+        if getattr(e.orig, "sqlite_errorname", None) != "SQLITE_CONSTRAINT_FOREIGNKEY":
+            raise
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Site or Device Type not found")
+
 @app.post("/device/device_type/{device_type_id}/site/{site_id}", response_model=Device)
 # create new device
 async def device_new(device: Device, device_type_id: int, site_id:int, session: AsyncSession = Depends(get_async_session)):
@@ -349,49 +458,40 @@ async def device_new(device: Device, device_type_id: int, site_id:int, session:
     This endpoint allows you to create a new device with a unique name, device type, and site.
     If the device type or site does not exist, it raises an error.
     """
-    res = await session.execute(select(DeviceType).where(DeviceType.id==id))
-    device_type = res.scalar_one_or_none()
-    if not device_type:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Device Type not found")
-    res = await session.execute(select(Site).where(Site.id==id))
-    site = res.scalar_one_or_none()
-    if not site:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Site not found")
-    device.device_type = device_type
-    device.site = site
+    # Foreign keys reject an unknown site or device type at commit, no pre-read needed
+    device.device_type_id = device_type_id
+    device.site_id = site_id
     if not device.name:
-        device.name = device.device_type.name
+        device_type = await session.get(DeviceType, device_type_id)
+        if not device_type:
+            # Same answer as the foreign key path in _commit_device
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Site or Device Type not found")
+        device.name = device_type.name
     session.add(device)
-    await session.commit()
-    session.refresh(device)
+    await _commit_device(session)
+    _invalidate(f"site/{site_id}/")
     return device
  
-@app.post("/device/{id}", response_model=Device)
+@app.post("/device/{device_id}", response_model=Device)
 # edit device
-async def device_edit(id: int,
+async def device_edit(device_id: int,
                      device_data: Device, session: AsyncSession = Depends(get_async_session)):
     """Edit an existing device by its ID.
     This endpoint allows you to update the name, site, and device type of a device.
+    A site or device type left out of the request is kept as it is.
     If the device does not exist, it raises an error.
     """
-    res = await session.execute(select(Device).where(Device.id==id))
-    device = res.scalar_one_or_none()
+    device = await session.get(Device, device_id)
     if not device:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Device not found")
     device.name = device_data.name
     device.is_active = device_data.is_active
-    res = await session.execute(select(Site).where(Site.id==id))
-    site = res.scalar_one_or_none()
-    if not site:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Site not found")
-    device.site = site
-    res = await session.execute(select(DeviceType).where(DeviceType.id==id))
-    device_type = res.scalar_one_or_none()
-    if not device_type:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Device Type not found")
-    device.device_type = device_type
-    await session.commit()
-    session.refresh(device)
+    if device_data.site_id is not None:
+        device.site_id = device_data.site_id
+    if device_data.device_type_id is not None:
+        device.device_type_id = device_data.device_type_id
+    await _commit_device(session)
+    _invalidate("site/", f"device/{device_id}/")
     return device
 
 @app.delete("/device/{id}", response_model=dict)
@@ -401,13 +501,11 @@ async def device_delete(id: int, session: AsyncSession = Depends(get_async_sessi
     This endpoint removes the device and all associated measures.
     If the device does not exist, it raises an error.
     """
-    res = await session.execute(select(Device).where(Device.id==id))
-    device = res.scalar_one_or_none()
-    if not device:
+    name = await _delete_by_id(session, Device, id)
+    if name is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Device not found")
-    session.delete(device)
-    await session.commit()
-    return {"ok": True, "message": f"Device {device.name} deleted"}
+    _invalidate("site/", f"device/{id}/")
+    return {"ok": True, "message": f"Device {name} deleted"}
     
 
 @app.get("/metrics/", response_model=list[MetricShort])
@@ -417,11 +515,14 @@ async def metrics(session: AsyncSession = Depends(get_async_session)):
     Get a list of all metrics.
     This endpoint returns all metrics available in the system.
     """
-    res = await session.execute(select(Metric))
+    key = "metrics"
+    if key in _response_cache:
+        return _response_cache[key]
+    res = await session.execute(_STMT_METRICS)
     metrics = res.scalars().all()
-    return [MetricShort(
-        id=metric.id, name=metric.name, unit=metric.unit, link=metric.link
-    ) for metric in metrics]
+    result = [MetricShort.model_validate(metric) for metric in metrics]
+    _response_cache[key] = result
+    return result
 
 @app.get("/metric/{id}", response_model=Metric)
 # metric details
@@ -429,40 +530,39 @@ async def metric(id: int, session: AsyncSession = Depends(get_async_session)):
     """Get details of a specific metric by its ID.
     This endpoint returns the metric information including its name, unit, and call function.
     """
-    res = await session.execute(select(Metric).where(Metric.id==id))
-    metric = res.scalar_one_or_none()
+    metric = await session.get(Metric, id)
     if not metric:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Metric not found")
     return metric
 
 @app.post("/metric/", response_model=Metric)
 # create new metric
-async def metric_new(metric: Metric, session: AsyncSession = Depends(get_async_session)):
+async def metric_new(metric_data: MetricBase, session: AsyncSession = Depends(get_async_session)):
     """Create a new metric.
     This endpoint allows you to create a new metric with a unique name, unit, and call function.
     """
+    metric = Metric.model_validate(metric_data)
     session.add(metric)
     await session.commit()
-    session.refresh(metric)
+    _invalidate("metrics")
     return metric
 
 @app.post("/metric/{id}", response_model=Metric)
 # edit metric
 async def metric_edit(id: int,
-                     metric_data: Metric, session: AsyncSession = Depends(get_async_session)):
+                     metric_data: MetricBase, session: AsyncSession = Depends(get_async_session)):
     """Edit an existing metric by its ID.
     This endpoint allows you to update the name, unit, and call function of a metric.
     If the metric does not exist, it raises an error.
     """
-    res = await session.execute(select(Metric).where(Metric.id==id))
-    metric = res.scalar_one_or_none()
+    metric = await session.get(Metric, id)
     if not metric:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Metric not found")
     metric.name = metric_data.name
     metric.unit = metric_data.unit
     metric.call = metric_data.call
     await session.commit()
-    session.refresh(metric)
+    _invalidate("metrics", "device/")
     return metric
 
 @app.delete("/metric/{id}", response_model=dict)
@@ -472,58 +572,52 @@ async def metric_delete(id: int, session: AsyncSession = Depends(get_async_sessi
     This endpoint removes the metric and all associated device type links.
     If the metric does not exist, it raises an error.
     """
-    res = await session.execute(select(Metric).where(Metric.id==id))
-    metric = res.scalar_one_or_none()
-    if not metric:
+    name = await _delete_by_id(session, Metric, id)
+    if name is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Metric not found")
-    session.delete(metric) 
-    await session.commit()
-    return {"ok": True, "message": f"Metric {metric.name} deleted"}
+    _invalidate("metrics", "device/")
+    return {"ok": True, "message": f"Metric {name} deleted"}
 
 @app.get("/history/{device_id}/{metric_id}", response_model=MeasuresHistory)
 # get measure history for device and metric
-async def measures_history(device_id: int, metric_id: int, session: AsyncSession = Depends(get_async_session)):
-    res = await session.execute(select(Device).options(
-        selectinload(Device.site), selectinload(Device.device_type)
-    ).where(Device.id==device_id))
-    device = res.scalar_one_or_none()
+async def measures_history(device_id: int, metric_id: int,
+                           before: AwareDatetime | None = None,
+                           limit: int = Query(500, ge=1, le=10000), offset: int = Query(0, ge=0),
+                           session: AsyncSession = Depends(get_async_session)):
+    """
+    Get the measure history of a device for one metric, newest first.
+    Pass the returned next_cursor as before to get the next page;
+    offset is kept for simple paging but gets slower on long histories.
+    """
+    res = await session.execute(
+        _select_by_ids((Device, device_id), (Metric, metric_id))
+        .options(joinedload(Device.site), joinedload(Device.device_type), raiseload("*"))
+    )
+    device, metric = res.one()
     if not device:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Device not found")
-    res = await session.execute(select(Metric).where(Metric.id==metric_id))
-    metric = res.scalar_one_or_none()
     if not metric:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Metric not found")
-    res = await session.execute(
-        select(Measure)
-        .where(Measure.device_id == device.id, Measure.metric_id == metric.id)
-        .order_by(Measure.timestamp.desc())
+    stmt = select(Measure).where(
+        Measure.device_id == device.id, Measure.metric_id == metric.id
     )
-    measures = res.scalars().all()
+    if before is not None:
+        # Timestamps are stored in UTC, compare against the same offset
+        stmt = stmt.where(Measure.timestamp < before.astimezone(timezone.utc))
+    # Stream the requested page instead of buffering the whole result
+    measures = await session.stream_scalars(
+        stmt.order_by(Measure.timestamp.desc())
+        .limit(limit).offset(offset)
+        .execution_options(yield_per=200)
+    )
+    history = [measure async for measure in measures]
     return MeasuresHistory(
-        device=DeviceShort(
-            id=device.id,
-            name=device.name,
-            link=device.link,
-        ),
-        site=SiteShort(
-            id=device.site.id, name=device.site.name, link=device.site.link
-        ),
-        device_type=DeviceTypeShort(
-            id=device.device_type.id, name=device.device_type.name, link=device.device_type.link
-        ),
-        metric=MetricShort(
-            id=metric.id,
-            name=metric.name,
-            unit=metric.unit,
-            link=metric.link
-        ),
-        history=[
-            MeasureShort(
-                value=measure.value,
-                timestamp=measure.timestamp
-            )
-            for measure in measures
-        ]
+        device=device,
+        site=device.site,
+        device_type=device.device_type,
+        metric=metric,
+        history=history,
+        next_cursor=history[-1].timestamp if len(history) == limit else None
     )
 
 
@@ -2,8 +2,53 @@
 """
 Author: Nina Belyavskaya
 """
+from collections.abc import Callable
+
+from sqlalchemy import func
+
 from .models import Device, Metric
 
+MeasureFunc = Callable[[Metric, Device], float]
+# Measures a batch of (metric, device) pairs in one go, returning values in order
+BatchFunc = Callable[[list[tuple[Metric, Device]]], list[float]]
+
+# Batch functions that Metric.call may name, filled once at import time by @register
+MEASURE_FUNCS: dict[str, BatchFunc] = {}
+
+
+def _per_item(func: MeasureFunc) -> BatchFunc:
+    """
+    Default batch protocol for a function measuring a single pair: call it for each item.
+    """
+    def batch(items: list[tuple[Metric, Device]]) -> list[float]:
+        return [func(metric, device) for metric, device in items]
+    return batch
+
+
+def register(name: str, batch: bool = False):
+    """
+    Decorator to make a measure function available to metrics under the given name.
+    With batch=True the function takes the whole list of (metric, device) pairs
+    using it, so a collector can poll all of them in one request.
+    """
+    def decorator(func):
+        if name in MEASURE_FUNCS:
+            raise ValueError(f"Function '{name}' is already registered")
+        MEASURE_FUNCS[name] = func if batch else _per_item(func)
+        return func
+    return decorator
+
+
+# Functions whose value can be computed by the database itself. Their measures
+# are written with a single INSERT ... SELECT instead of being called per pair.
+SQL_MEASURES = {
+    # SQLite's random() is a signed 64-bit integer; abs() of its minimum value
+    # overflows, so fold the signed remainder into 0..98 instead
+    "mock": (func.random() % 99 + 99) % 99 + 1,
+}
+
+
+@register("mock")
 def mock(metric: Metric, device: Device) -> float:
     """
     Mock function to simulate fetching a metric value for a device.
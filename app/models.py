@@ -5,6 +5,8 @@ Author: Nina Belyavskaya
 from typing import List, Optional
 
 from sqlmodel import SQLModel, Field, Relationship
+from pydantic import field_validator
+from sqlalchemy import Index
 from datetime import datetime
 
 
@@ -35,13 +37,26 @@ class SiteView(SQLModel):
     
 
 # Metric model represents a metric that can be associated with device types.
-class Metric(SQLModel, table=True):
-    """Model representing a metric that can be associated with device types."""
-    id: int | None = Field(default=None, primary_key=True)
+class MetricBase(SQLModel):
+    """Fields of a metric as sent when creating or editing it."""
     name: str = Field(index=True, unique=True)  # Unique name for the metric
     unit: str = Field(nullable=False)  # Unit of measurement for the metric
     call: str = Field(default="mock")  # Function name to call
 
+    @field_validator("call")
+    @classmethod
+    def check_call(cls, value: str) -> str:
+        """Only accept function names registered in measure.py."""
+        from .measure import MEASURE_FUNCS  # measure.py imports this module
+        if value not in MEASURE_FUNCS:
+            raise ValueError(f"Unknown measure function '{value}'")
+        return value
+
+
+class Metric(MetricBase, table=True):
+    """Model representing a metric that can be associated with device types."""
+    id: int | None = Field(default=None, primary_key=True)
+
     @property
     def link(self) -> str: 
         return f"/metric/{self.id}/"  # Link to the metric view
@@ -57,7 +72,7 @@ class MetricShort(SQLModel):
 # Association table for Many-to-Many relationship between DeviceType and Metric.
 class DeviceTypeMetricLink(SQLModel, table=True):
     """Association table for Many-to-Many relationship between DeviceType and Metric."""
-    device_type_id: int | None = Field(foreign_key="devicetype.id", primary_key=True)
+    device_type_id: int | None = Field(foreign_key="devicetype.id", primary_key=True, ondelete="CASCADE")
     metric_id: int | None = Field(foreign_key="metric.id", primary_key=True, ondelete="CASCADE")
     
 
@@ -92,7 +107,7 @@ class Device(SQLModel, table=True):
     name: str = Field(index=True) 
     site_id: int | None = Field(foreign_key="site.id", nullable=False, ondelete="CASCADE")
     device_type_id: int | None = Field(foreign_key="devicetype.id", nullable=False, ondelete="CASCADE")
-    is_active: bool = Field(default=True)
+    is_active: bool = Field(default=True, index=True)
 
     site: Site = Relationship(back_populates="devices")
     device_type: DeviceType = Relationship()
@@ -119,9 +134,14 @@ class DeviceView(SQLModel):
 
 # Measure model represents a measurement taken by a device for a specific metric at a given time.
 class Measure(SQLModel, table=True):
+    # Covers the per-device and per-(device, metric) lookups ordered by timestamp
+    __table_args__ = (
+        Index("ix_measure_device_metric_ts", "device_id", "metric_id", "timestamp"),
+    )
+
     id: int | None = Field(default=None, primary_key=True)
     device_id: int | None = Field(foreign_key="device.id", ondelete="CASCADE")
-    metric_id: int | None = Field(foreign_key="metric.id", ondelete="CASCADE")
+    metric_id: int | None = Field(foreign_key="metric.id", ondelete="CASCADE", index=True)
     value: float
     timestamp: datetime
 
@@ -151,3 +171,4 @@ class MeasuresHistory(SQLModel):
     device_type: DeviceTypeShort  # Device type associated with the measures
     metric: MetricShort  # Metric associated with the measures
     history: List[MeasureShort] = []  # List of measures for the device and metric
+    next_cursor: Optional[datetime] = None  # Pass as `before` to get the next page
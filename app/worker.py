@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+"""
+Author: Nina Belyavskaya
+
+Standalone measurement process, for deployments serving the API with several
+workers (start them with MEASURE_IN_APP=0). It is the only process creating
+the tables, so start it before the API:
+
+    python -m app.worker
+"""
+import asyncio
+
+from .db import create_db_and_tables
+from .main import check_metric_calls, start_scheduler
+
+
+async def main():
+    await create_db_and_tables()
+    await check_metric_calls()
+    start_scheduler()
+    await asyncio.Event().wait()  # Run until the process is stopped
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+import os
+import sqlite3
+
+import pytest
+from fastapi.testclient import TestClient
+
+# Schema as created by the first release, before any index or cascade was added
+BASELINE_SCHEMA = """
+CREATE TABLE site (
+    id INTEGER NOT NULL,
+    name VARCHAR NOT NULL,
+    PRIMARY KEY (id)
+);
+CREATE UNIQUE INDEX ix_site_name ON site (name);
+CREATE TABLE metric (
+    id INTEGER NOT NULL,
+    name VARCHAR NOT NULL,
+    unit VARCHAR NOT NULL,
+    call VARCHAR NOT NULL,
+    PRIMARY KEY (id)
+);
+CREATE UNIQUE INDEX ix_metric_name ON metric (name);
+CREATE TABLE devicetype (
+    id INTEGER NOT NULL,
+    name VARCHAR NOT NULL,
+    PRIMARY KEY (id)
+);
+CREATE UNIQUE INDEX ix_devicetype_name ON devicetype (name);
+CREATE TABLE devicetypemetriclink (
+    device_type_id INTEGER NOT NULL,
+    metric_id INTEGER NOT NULL,
+    PRIMARY KEY (device_type_id, metric_id),
+    FOREIGN KEY(device_type_id) REFERENCES devicetype (id),
+    FOREIGN KEY(metric_id) REFERENCES metric (id) ON DELETE CASCADE
+);
+CREATE TABLE device (
+    id INTEGER NOT NULL,
+    name VARCHAR NOT NULL,
+    site_id INTEGER NOT NULL,
+    device_type_id INTEGER NOT NULL,
+    is_active BOOLEAN NOT NULL,
+    PRIMARY KEY (id),
+    FOREIGN KEY(site_id) REFERENCES site (id) ON DELETE CASCADE,
+    FOREIGN KEY(device_type_id) REFERENCES devicetype (id) ON DELETE CASCADE
+);
+CREATE INDEX ix_device_name ON device (name);
+CREATE TABLE measure (
+    id INTEGER NOT NULL,
+    device_id INTEGER,
+    metric_id INTEGER,
+    value FLOAT NOT NULL,
+    timestamp DATETIME NOT NULL,
+    PRIMARY KEY (id),
+    FOREIGN KEY(device_id) REFERENCES device (id) ON DELETE CASCADE,
+    FOREIGN KEY(metric_id) REFERENCES metric (id) ON DELETE CASCADE
+);
+"""
+
+
+@pytest.fixture(scope="session")
+def baseline_db(tmp_path_factory):
+    """
+    An existing database.db with the baseline schema, in the working directory.
+    The engine keeps the path it first connected to, so the whole session
+    shares this one database and tests create their own rows.
+    """
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp("db"))
+    with sqlite3.connect("database.db") as db:
+        db.executescript(BASELINE_SCHEMA)
+    yield os.path.abspath("database.db")
+    os.chdir(cwd)
+
+
+@pytest.fixture(scope="session")
+def client(baseline_db):
+    """Test client for the app started on the baseline database."""
+    from app.main import app
+
+    with TestClient(app) as client:
+        yield client
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+import sqlite3
+
+
+def _index_names(db_path):
+    with sqlite3.connect(db_path) as db:
+        return {name for (name,) in db.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+
+
+def test_startup_adds_model_indexes_to_existing_tables(baseline_db, client):
+    indexes = _index_names(baseline_db)
+    assert "ix_measure_device_metric_ts" in indexes
+    assert "ix_device_is_active" in indexes
+
+
+def test_startup_collects_planner_statistics(baseline_db, client):
+    with sqlite3.connect(baseline_db) as db:
+        assert db.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'").fetchone()
+
+
+def test_startup_indexes_measure_metric_for_cascades(baseline_db, client):
+    assert "ix_measure_metric_id" in _index_names(baseline_db)
+    with sqlite3.connect(baseline_db) as db:
+        plan = db.execute("EXPLAIN QUERY PLAN DELETE FROM measure WHERE metric_id = 1").fetchall()
+    assert any("ix_measure_metric_id" in row[-1] for row in plan)
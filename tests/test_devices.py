@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+NOT_FOUND = {"detail": "Site or Device Type not found"}
+
+
+@pytest.fixture
+def site_and_type(client, request):
+    """A site and a device type named after the calling test."""
+    site = client.post("/site/", json={"name": f"site {request.node.name}"}).json()
+    device_type = client.post("/device_type/", json={"name": f"type {request.node.name}"}).json()
+    return site["id"], device_type["id"]
+
+
+def test_device_new_with_unknown_site_is_404(client, site_and_type):
+    _, device_type_id = site_and_type
+    res = client.post(f"/device/device_type/{device_type_id}/site/999999", json={"name": "d"})
+    assert res.status_code == 404
+    assert res.json() == NOT_FOUND
+
+
+def test_device_new_unnamed_with_unknown_type_is_404(client, site_and_type):
+    site_id, _ = site_and_type
+    res = client.post(f"/device/device_type/999999/site/{site_id}", json={"name": ""})
+    assert res.status_code == 404
+    assert res.json() == NOT_FOUND
+
+
+def test_device_edit_without_ids_keeps_site_and_type(client, site_and_type):
+    site_id, device_type_id = site_and_type
+    device = client.post(f"/device/device_type/{device_type_id}/site/{site_id}", json={"name": "d"}).json()
+    res = client.post(f"/device/{device['id']}", json={"name": "renamed"})
+    assert res.status_code == 200
+    assert res.json()["name"] == "renamed"
+    assert (res.json()["site_id"], res.json()["device_type_id"]) == (site_id, device_type_id)
+
+
+def test_device_edit_with_unknown_site_is_404(client, site_and_type):
+    site_id, device_type_id = site_and_type
+    device = client.post(f"/device/device_type/{device_type_id}/site/{site_id}", json={"name": "d"}).json()
+    res = client.post(f"/device/{device['id']}", json={"name": "d", "site_id": 999999})
+    assert res.status_code == 404
+    assert res.json() == NOT_FOUND
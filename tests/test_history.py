@@ -0,0 +1,7 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+
+@pytest.mark.parametrize("params", [{"offset": -5}, {"limit": 0}])
+def test_history_rejects_bad_paging(client, params):
+    assert client.get("/history/1/1", params=params).status_code == 422